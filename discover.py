@@ -1,10 +1,12 @@
 import requests
-from bs4 import BeautifulSoup
-import json
+import lxml.html
+from lxml import etree
 import re
 from urllib.parse import urljoin, urlparse
-import time
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import os
+from manifest_cache import load_json, save_json
 
 # --- Configuration ---
 USER_AGENT = "PAU-Collector/1.0 (+https://your.agent)"
@@ -23,13 +25,13 @@ SEED_URLS = [
     "https://www.juntadeandalucia.es/educacion/permanente/materiales/index.php?etapa=6&materia=78"
 ]
 ALLOWED_PATTERNS = [r'viewscorm\.jsp.*vi=downloadIms']
+ALLOWED_REGEXES = [re.compile(pattern, re.IGNORECASE) for pattern in ALLOWED_PATTERNS]
+ANCHORS_XPATH = etree.XPath('//a[@href]')
 MANIFEST_FILE = "manifest.json"
+DISCOVERY_WORKERS = 4
 
 def is_allowed(url):
-    for pattern in ALLOWED_PATTERNS:
-        if re.search(pattern, url, re.IGNORECASE):
-            return True
-    return False
+    return any(regex.search(url) for regex in ALLOWED_REGEXES)
 
 def get_subject_from_url(url):
     try:
@@ -40,51 +42,76 @@ def get_subject_from_url(url):
     except Exception:
         return "unknown_subject"
 
-def discover_links(seed_url):
+def discover_links(seed_url, session):
     discovered_resources = []
-    headers = {'User-Agent': USER_AGENT}
     print(f"[*] Crawling seed URL for subject: {get_subject_from_url(seed_url)}")
     try:
-        response = requests.get(seed_url, headers=headers, timeout=60)
+        response = session.get(seed_url, timeout=60)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"[!] Error fetching {seed_url}: {e}")
         return []
 
-    soup = BeautifulSoup(response.content, 'html.parser')
-    links = soup.find_all('a', href=True)
+    # requests assumes ISO-8859-1 when the server names no charset; detect it instead, as BeautifulSoup did.
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        encoding = response.encoding
+    else:
+        encoding = response.apparent_encoding
+    try:
+        tree = lxml.html.fromstring(response.content, parser=lxml.html.HTMLParser(encoding=encoding))
+    except etree.ParserError as e:
+        print(f"[!] Error parsing {seed_url}: {e}")
+        return []
+    links = ANCHORS_XPATH(tree)
     subject = get_subject_from_url(seed_url)
 
+    seen_urls = set()
     for link in links:
-        href = link['href']
+        href = link.get('href')
         absolute_url = urljoin(seed_url, href)
-        if is_allowed(absolute_url):
-            resource_id = hashlib.md5(absolute_url.encode()).hexdigest()
-            resource_info = {
+        if is_allowed(absolute_url) and absolute_url not in seen_urls:
+            seen_urls.add(absolute_url)
+            resource_id = hashlib.md5(absolute_url.encode(), usedforsecurity=False).hexdigest()
+            discovered_resources.append({
                 'id': resource_id,
                 'source_seed': seed_url,
                 'url': absolute_url,
-                'link_text': link.get_text(strip=True),
+                'link_text': "".join(text.strip() for text in link.itertext()),
                 'inferred_type': 'scorm_package',
                 'referer_origin': seed_url,
                 'subject': subject
-            }
-            if not any(d['url'] == absolute_url for d in discovered_resources):
-                discovered_resources.append(resource_info)
+            })
     return discovered_resources
 
+def carry_over_manual_flags(resources):
+    """
+    Copies keys added by hand to the existing manifest (e.g. "text_only": true)
+    onto the matching freshly discovered resources, so rediscovery keeps them.
+    """
+    if not os.path.exists(MANIFEST_FILE):
+        return
+    previous = {(r['url'], r['subject']): r for r in load_json(MANIFEST_FILE)}
+    for resource in resources:
+        old = previous.get((resource['url'], resource['subject']))
+        if old is not None:
+            for key, value in old.items():
+                resource.setdefault(key, value)
+
 def main():
     all_discovered_resources = []
     print("[*] Starting discovery process...")
-    for url in SEED_URLS:
-        resources = discover_links(url)
-        all_discovered_resources.extend(resources)
-        print(f"[*] Found {len(resources)} unique packages for subject: {get_subject_from_url(url)}")
-        time.sleep(1)
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    # Seed pages are independent, so crawl them concurrently over one keep-alive session.
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        results = executor.map(lambda url: discover_links(url, session), SEED_URLS)
+        for url, resources in zip(SEED_URLS, results):
+            all_discovered_resources.extend(resources)
+            print(f"[*] Found {len(resources)} unique packages for subject: {get_subject_from_url(url)}")
 
     all_discovered_resources.sort(key=lambda x: x['subject'])
-    with open(MANIFEST_FILE, 'w', encoding='utf-8') as f:
-        json.dump(all_discovered_resources, f, indent=4, ensure_ascii=False)
+    carry_over_manual_flags(all_discovered_resources)
+    save_json(MANIFEST_FILE, all_discovered_resources)
     print(f"\n[SUCCESS] Discovery complete. Manifest saved to: {MANIFEST_FILE}")
 
 if __name__ == "__main__":
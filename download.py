@@ -1,8 +1,13 @@
-import json
 import os
-import subprocess
+import re
 import hashlib
+import mmap
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote, urlparse
+import requests
+import urllib3
+from manifest_cache import load_manifest, load_json, save_json
 
 # --- Configuration ---
 MANIFEST_FILE = "manifest_discovery.json"
@@ -11,19 +16,80 @@ CHECKSUMS_FILE = "checksums.json"
 USER_AGENT = "PAU-Collector/1.0 (+https://your.agent)"
 MAX_RETRIES = 3
 RETRY_BACKOFF_SECONDS = [2, 8, 30]
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 def calculate_sha256(filepath):
     """Calculates the SHA256 checksum of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
-
-def download_file(resource_info):
+    with open(filepath, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: hashlib reads the file in its own C loop
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+def is_already_downloaded(entry):
     """
-    Downloads a single file using wget, with retries and backoff.
+    Checks that a previously downloaded file is still on disk. The file is only
+    re-hashed when its size or mtime no longer match the recorded fingerprint.
+    """
+    if entry['sha256'] == 'download_failed':
+        return False
+    if 'size' not in entry:
+        # Recorded before stat fingerprints were kept; trust it as before.
+        return True
+
+    local_path = entry['local_path']
+    if not local_path or not os.path.exists(local_path):
+        return False
+
+    st = os.stat(local_path)
+    if st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if calculate_sha256(local_path) != entry['sha256']:
+        return False
+    entry['size'], entry['mtime_ns'] = st.st_size, st.st_mtime_ns
+    return True
+
+def make_session():
+    """Creates the HTTP session shared by all downloads so connections are kept alive."""
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    # Same as the previous `wget --no-check-certificate`
+    session.verify = False
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return session
+
+def filename_from_response(response, url):
+    """Takes the file name from Content-Disposition, falling back to the last segment of the URL path."""
+    disposition = response.headers.get('Content-Disposition', '')
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", disposition, re.IGNORECASE)
+    if match:
+        filename = unquote(match.group(1).strip().strip('"'))
+    else:
+        match = re.search(r'filename="?([^";]+)"?', disposition, re.IGNORECASE)
+        filename = match.group(1).strip() if match else os.path.basename(urlparse(url).path)
+    return os.path.basename(filename) or "download"
+
+def open_unique(directory, filename):
+    """
+    Opens a new file in directory without overwriting an existing one,
+    appending .1, .2, ... to the name as wget does.
+    """
+    filepath = os.path.join(directory, filename)
+    suffix = 0
+    while True:
+        try:
+            return filepath, open(filepath, 'xb')
+        except FileExistsError:
+            suffix += 1
+            filepath = os.path.join(directory, f"{filename}.{suffix}")
+
+def download_file(resource_info, session):
+    """
+    Downloads a single file over the shared session, with retries and backoff.
     """
     url = resource_info['url']
     subject = resource_info['subject']
@@ -37,35 +103,24 @@ def download_file(resource_info):
     if "downloadIms" not in url:
         return None, "skipped_not_a_package"
 
-    command = [
-        'wget',
-        '--content-disposition',
-        '--no-check-certificate',
-        f'--user-agent={USER_AGENT}',
-        f'--referer={resource_info["referer_origin"]}',
-        '-P', subject_dir,
-        url
-    ]
-
     for attempt in range(MAX_RETRIES):
+        filepath = None
         try:
             print(f"[*] Downloading (Attempt {attempt + 1}/{MAX_RETRIES}): {url}")
-            process = subprocess.run(command, check=True, capture_output=True, text=True, timeout=300)
-
-            for line in process.stderr.splitlines():
-                if 'Saving to: ‘' in line:
-                    filepath = line.split('Saving to: ‘')[-1].strip().replace('’', '')
-                    print(f"  [+] Saved to: {filepath}")
-                    return filepath, "downloaded"
-
-            print(f"[!] Download succeeded but could not determine filename for {url}")
-            return None, "failed_to_get_filename"
-
-        except subprocess.CalledProcessError as e:
-            print(f"[!] wget error for {url}. Return code: {e.returncode}")
-            print(f"  Stderr: {e.stderr}")
-        except subprocess.TimeoutExpired:
-            print(f"[!] Timeout expired for {url}.")
+            with session.get(url, headers={'Referer': resource_info['referer_origin']}, stream=True, timeout=300) as response:
+                response.raise_for_status()
+                filepath, f = open_unique(subject_dir, filename_from_response(response, url))
+                with f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            print(f"  [+] Saved to: {filepath}")
+            return filepath, "downloaded"
+
+        except (requests.exceptions.RequestException, OSError) as e:
+            # OSError covers local write failures such as a full disk.
+            print(f"[!] Download error for {url}: {e}")
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
 
         if attempt < MAX_RETRIES - 1:
             backoff_time = RETRY_BACKOFF_SECONDS[attempt]
@@ -75,6 +130,29 @@ def download_file(resource_info):
     print(f"[!!!] FAILED to download {url} after {MAX_RETRIES} attempts.")
     return None, "failed_after_retries"
 
+def download_and_hash(resource_info, session):
+    """Downloads one resource and returns its checksums entry, or None if it is not a package."""
+    downloaded_filepath, status = download_file(resource_info, session)
+
+    if status == "downloaded":
+        checksum = calculate_sha256(downloaded_filepath)
+        st = os.stat(downloaded_filepath)
+        print(f"  [+] Checksum (SHA256): {checksum}")
+        return {
+            'local_path': downloaded_filepath,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': checksum,
+            'status': 'downloaded'
+        }
+    if status == "skipped_not_a_package":
+        return None
+    return {
+        'local_path': None,
+        'sha256': 'download_failed',
+        'status': status
+    }
+
 def main():
     """
     Main function to orchestrate the download process.
@@ -83,41 +161,40 @@ def main():
         print(f"[!] Manifest file not found: {MANIFEST_FILE}")
         return
 
-    with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
-        resources = json.load(f)
+    resources = load_manifest(MANIFEST_FILE)
 
     checksums = {}
     if os.path.exists(CHECKSUMS_FILE):
-        with open(CHECKSUMS_FILE, 'r') as f:
-            checksums = json.load(f)
+        checksums = load_json(CHECKSUMS_FILE)
 
+    pending = []
+    refreshed = False
     for resource in resources:
-        if resource['url'] in checksums and checksums[resource['url']]['sha256'] != 'download_failed':
-            print(f"[*] Skipping already downloaded file: {resource['url']}")
-            continue
-
-        downloaded_filepath, status = download_file(resource)
-
-        if status == "downloaded" and downloaded_filepath and os.path.exists(downloaded_filepath):
-            checksum = calculate_sha256(downloaded_filepath)
-            checksums[resource['url']] = {
-                'local_path': downloaded_filepath,
-                'sha256': checksum,
-                'status': 'downloaded'
-            }
-            print(f"  [+] Checksum (SHA256): {checksum}")
-        elif status != "skipped_not_a_package":
-            checksums[resource['url']] = {
-                'local_path': None,
-                'sha256': 'download_failed',
-                'status': status
-            }
-
-        # Save checksums after each attempt to checkpoint progress
-        with open(CHECKSUMS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(checksums, f, indent=4)
+        entry = checksums.get(resource['url'])
+        if entry is not None:
+            fingerprint = (entry.get('size'), entry.get('mtime_ns'))
+            if is_already_downloaded(entry):
+                refreshed |= fingerprint != (entry.get('size'), entry.get('mtime_ns'))
+                print(f"[*] Skipping already downloaded file: {resource['url']}")
+                continue
+        pending.append(resource)
+
+    # Persist fingerprints refreshed after a re-hash, even if nothing needs downloading.
+    if refreshed:
+        save_json(CHECKSUMS_FILE, checksums)
+
+    session = make_session()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {executor.submit(download_and_hash, resource, session): resource for resource in pending}
+        for future in as_completed(futures):
+            entry = future.result()
+            if entry is not None:
+                checksums[futures[future]['url']] = entry
+
+            # Save checksums after each attempt to checkpoint progress
+            save_json(CHECKSUMS_FILE, checksums)
 
     print("\n[SUCCESS] Download stage complete.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,10 @@
 import os
-import json
 import hashlib
+import html
+import mmap
 import glob
+from concurrent.futures import ThreadPoolExecutor
+from manifest_cache import load_json, save_json
 
 # --- Configuration ---
 FINAL_DIR = "final_deliverables"
@@ -13,17 +16,36 @@ CHECKSUMS_FILE = "checksums.json"
 
 def calculate_sha256(filepath):
     """Calculates the SHA256 checksum of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    with open(filepath, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: hashlib reads the file in its own C loop
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+def cached_sha256(filepath, previous_checksums):
+    """
+    Returns the checksum entry for a file, reusing the previous digest
+    when the file's size and mtime are unchanged since it was recorded.
+    """
+    st = os.stat(filepath)
+    entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    previous = previous_checksums.get(os.path.basename(filepath))
+    if isinstance(previous, dict) and previous.get('size') == st.st_size and previous.get('mtime_ns') == st.st_mtime_ns:
+        entry['sha256'] = previous['sha256']
+    else:
+        entry['sha256'] = calculate_sha256(filepath)
+    return entry
 
 def generate_qa_report(files):
     """Generates a simple HTML report listing the created files and their sizes."""
-    html = "<html><head><title>QA Report</title><style>body { font-family: sans-serif; } table { border-collapse: collapse; } th, td { border: 1px solid #ccc; padding: 8px; } th { background-color: #f2f2f2; }</style></head><body>"
-    html += "<h1>QA Report: Generated Deliverables</h1>"
-    html += "<table><tr><th>File Name</th><th>Size (Bytes)</th></tr>"
+    parts = [
+        "<html><head><title>QA Report</title><style>body { font-family: sans-serif; } table { border-collapse: collapse; } th, td { border: 1px solid #ccc; padding: 8px; } th { background-color: #f2f2f2; }</style></head><body>",
+        "<h1>QA Report: Generated Deliverables</h1>",
+        "<table><tr><th>File Name</th><th>Size (Bytes)</th></tr>",
+    ]
 
     file_details = []
     for f in sorted(files):
@@ -34,12 +56,12 @@ def generate_qa_report(files):
             file_details.append({'name': os.path.basename(f), 'size': 'N/A'})
 
     for item in file_details:
-        html += f"<tr><td>{item['name']}</td><td>{item['size']}</td></tr>"
+        parts.append(f"<tr><td>{html.escape(item['name'])}</td><td>{item['size']}</td></tr>")
 
-    html += "</table></body></html>"
+    parts.append("</table></body></html>")
 
     with open(QA_REPORT_FILE, 'w', encoding='utf-8') as f:
-        f.write(html)
+        f.write("".join(parts))
     print(f"[+] QA Report generated: {QA_REPORT_FILE}")
 
 def main():
@@ -54,15 +76,20 @@ def main():
     # 1. Generate QA Report
     generate_qa_report(final_files)
 
-    # 2. Generate checksums for final files
-    checksums = {}
+    # 2. Generate checksums for final files, skipping files unchanged since the last run
+    previous_checksums = {}
+    if os.path.exists(CHECKSUMS_FILE):
+        previous_checksums = load_json(CHECKSUMS_FILE)
+
     print("[*] Calculating checksums for final deliverables...")
-    for f in sorted(final_files):
+    final_files = sorted(final_files)
+    for f in final_files:
         print(f"  - Processing {os.path.basename(f)}...")
-        checksums[os.path.basename(f)] = calculate_sha256(f)
+    # hashlib releases the GIL while hashing large buffers, so threads hash files in parallel.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        checksums = dict(zip([os.path.basename(f) for f in final_files], executor.map(lambda f: cached_sha256(f, previous_checksums), final_files)))
 
-    with open(CHECKSUMS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(checksums, f, indent=4)
+    save_json(CHECKSUMS_FILE, checksums)
     print(f"[+] Final checksums generated: {CHECKSUMS_FILE}")
 
     print(f"\n[SUCCESS] Documentation and finalization complete.")
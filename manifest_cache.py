@@ -0,0 +1,51 @@
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+# Decoded manifests for the lifetime of the process, keyed by absolute path.
+# Each entry remembers the (mtime_ns, size) stamp it was decoded from.
+_cache = {}
+
+def load_json(path):
+    """Decodes a JSON file, using orjson when it is installed."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def save_json(path, obj):
+    """Writes obj as UTF-8 JSON indented by two spaces, using orjson when it is installed."""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def load_manifest(path):
+    """
+    Returns the decoded JSON manifest at path.
+
+    The result is reused for the rest of the process while the file's mtime and
+    size are unchanged.
+    Callers must treat the returned object as read-only.
+    """
+    key = os.path.abspath(path)
+    stamp = _stamp(path)
+
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    data = load_json(path)
+    _cache[key] = (stamp, data)
+    return data
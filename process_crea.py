@@ -1,23 +1,73 @@
 import requests
-import json
 import os
 import io
 import zipfile
+import hashlib
 import subprocess
-import time
 import shutil
-import sys
+import tempfile
+import glob
+import argparse
+import asyncio
+import threading
+import mimetypes
+import re
+import html
+import posixpath
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, unquote, urlparse
 from collections import defaultdict
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
+from concurrent.futures import ThreadPoolExecutor
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 import pikepdf
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from manifest_cache import load_manifest
 
 # --- Configuration ---
 MANIFEST_FILE = "manifest.json"
 OUTPUT_DIR = "final_deliverables"
 USER_AGENT = "PAU-Collector/1.0 (+https://your.agent)"
 LOG_FILE = "processing_log.txt"
-TEMP_DIR = "temp_processing"
+# Keep rendered pages on tmpfs when available so they never touch the disk.
+TEMP_DIR = "/dev/shm/pau_crea_processing" if os.path.isdir("/dev/shm") else "temp_processing"
+# Raw packages on disk. Each is deleted as soon as its resource renders, so only the
+# packages of resources that failed are left for a rerun to reuse.
+DOWNLOAD_CACHE = "download_cache"
+# Default number of resources rendered at once; override with --workers.
+RENDER_CONCURRENCY = 4
+DOWNLOAD_WORKERS = 8
+# Placeholder origin the browser loads packages from; requests to it are answered from the zip.
+PACKAGE_ORIGIN = "http://scorm-package.invalid"
+# Request types dropped for resources flagged `"text_only": true` in the manifest.
+TEXT_ONLY_SKIPPED_TYPES = {"image", "media"}
+# Chromium flags that keep pages in background contexts from being throttled while we render concurrently.
+BROWSER_ARGS = [
+    '--run-all-compositor-stages-before-draw',
+    '--disable-background-timer-throttling',
+    '--disable-renderer-backgrounding',
+]
+# Resolves once MathJax (v2 or v3), if the page uses it, has finished typesetting.
+MATHJAX_READY_JS = """() => {
+    const mj = window.MathJax;
+    if (!mj) return true;
+    if (mj.startup && mj.startup.promise) return mj.startup.promise.then(() => true);
+    if (mj.Hub) return new Promise(resolve => mj.Hub.Queue(() => resolve(true)));
+    return true;
+}"""
+TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+BODY_RE = re.compile(rb'<body[^>]*>(.*?)</body>', re.IGNORECASE | re.DOTALL)
+
+# One pooled session for every package download, so connections to the CREA host are reused.
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = USER_AGENT
+_adapter = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
 
 def logger(message):
     """Logs a message to both the console and the log file."""
@@ -31,8 +81,7 @@ def get_resources_for_subject(target_subject):
         logger(f"[!!!] CRITICAL: Manifest file not found: {MANIFEST_FILE}")
         return None
 
-    with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
-        resources = json.load(f)
+    resources = load_manifest(MANIFEST_FILE)
 
     subject_resources = [r for r in resources if r['subject'] == target_subject]
 
@@ -43,84 +92,296 @@ def get_resources_for_subject(target_subject):
     logger(f"[*] Found {len(subject_resources)} resources for subject: {target_subject}")
     return subject_resources
 
-def process_subject(subject, resources, browser):
-    """Processes all resources for a single subject using a pure in-memory workflow."""
-    logger(f"\n{'='*40}")
-    logger(f"[*] Starting processing for subject: {subject}")
-    logger(f"{'='*40}")
-
-    pdf_page_files = []
-    epub_chapters_content = []
-
-    temp_subject_dir = os.path.join(TEMP_DIR, subject)
-    os.makedirs(temp_subject_dir, exist_ok=True)
-
-    for i, resource in enumerate(resources):
-        logger(f"\n--- Processing resource {i+1}/{len(resources)} for {subject} ---")
+def is_cached_copy_current(url, cache_path):
+    """
+    Checks a cached package against the server with a HEAD request. The copy is
+    only rejected when Content-Length or ETag positively disagree with it.
+    """
+    try:
+        response = SESSION.head(url, timeout=60, allow_redirects=True)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        return True
+
+    try:
+        content_length = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        content_length = None  # missing or malformed: unknown, not a mismatch
+    if content_length is not None and content_length != os.path.getsize(cache_path):
+        return False
+
+    etag = response.headers.get('ETag')
+    etag_path = cache_path + '.etag'
+    if etag and os.path.exists(etag_path):
+        with open(etag_path, 'r', encoding='utf-8') as f:
+            return f.read() == etag
+    return True
+
+def resource_key(resource):
+    """Short, stable key derived from the resource URL, used for cache file names."""
+    return hashlib.blake2b(resource['url'].encode(), digest_size=5).hexdigest()
+
+def cache_path_for(resource):
+    """Path of the resource's package in DOWNLOAD_CACHE."""
+    return os.path.join(DOWNLOAD_CACHE, f"{resource_key(resource)}.bin")
+
+def evict_cached_package(resource):
+    """Removes the resource's cached package and its ETag."""
+    cache_path = cache_path_for(resource)
+    for path in (cache_path, cache_path + '.etag', cache_path + '.part'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def download_package(i, resource):
+    """
+    Returns the path of a SCORM package in DOWNLOAD_CACHE, streaming it from the
+    server only when there is no current copy from an earlier run.
+    """
+    cache_path = cache_path_for(resource)
+    if os.path.exists(cache_path) and is_cached_copy_current(resource['url'], cache_path):
+        logger(f"  [+] Reusing cached download for resource {i+1}: {cache_path}")
+        return cache_path
+
+    partial_path = cache_path + '.part'
+    with SESSION.get(resource['url'], timeout=180, stream=True) as response, open(partial_path, 'wb') as f:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, f, 1 << 20)
+        etag = response.headers.get('ETag')
+    os.replace(partial_path, cache_path)
+    if etag:
+        with open(cache_path + '.etag', 'w', encoding='utf-8') as f:
+            f.write(etag)
+    logger(f"  [+] Downloaded resource {i+1} to {cache_path}.")
+    return cache_path
+
+async def serve_from_zip(route, z):
+    """Answers a request to PACKAGE_ORIGIN with the matching entry of the open package."""
+    name = unquote(urlparse(route.request.url).path).lstrip('/')
+    try:
+        # Entries can be large media files; decompress them off the event loop.
+        body = await asyncio.to_thread(z.read, name)
+    except KeyError:
+        await route.fulfill(status=404)
+        return
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    await route.fulfill(status=200, body=body, content_type=content_type)
+
+def find_entry_point(z, html_files):
+    """
+    Returns the package's entry page: the first <resource href> declared in
+    imsmanifest.xml, or, failing that, the first HTML file named like an index.
+    """
+    names = z.namelist()
+    manifests = sorted((n for n in names if posixpath.basename(n) == 'imsmanifest.xml'), key=len)
+    if manifests:
+        try:
+            resource = ET.fromstring(z.read(manifests[0])).find('.//{*}resource[@href]')
+        except ET.ParseError:
+            resource = None
+        if resource is not None:
+            href = unquote(resource.get('href').split('#')[0].split('?')[0])
+            entry = posixpath.normpath(posixpath.join(posixpath.dirname(manifests[0]), href))
+            if entry in names:
+                return entry
+    return next((f for f in html_files if 'index' in f.lower()), html_files[0])
+
+def extract_title_and_body(data):
+    """Pulls the <title> text and the inner <body> markup out of an HTML document without parsing the DOM."""
+    # Not every package is UTF-8; older ones are Latin-1/Windows-1252.
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        data = data.decode('cp1252', errors='replace').encode('utf-8')
+    title_match = TITLE_RE.search(data)
+    title = html.unescape(title_match.group(1).decode('utf-8')).strip() if title_match else ""
+    body_match = BODY_RE.search(data)
+    body = (body_match.group(1) if body_match else data).decode('utf-8')
+    return title, body
+
+async def skip_media(route):
+    """Aborts image and media requests; everything else falls through to the other routes."""
+    if route.request.resource_type in TEXT_ONLY_SKIPPED_TYPES:
+        await route.abort()
+    else:
+        await route.fallback()
+
+async def wait_until_ready(browser_page):
+    """Waits for the page's content, MathJax and fonts to settle, tolerating slow pages."""
+    try:
+        await browser_page.wait_for_function(MATHJAX_READY_JS, timeout=15000)
+        await browser_page.wait_for_selector('body *', state='attached', timeout=10000)
+        await browser_page.wait_for_function("document.fonts ? document.fonts.ready.then(() => true) : true", timeout=5000)
+    except PlaywrightTimeoutError:
+        logger("  [!] Page did not settle in time; rendering it as it is.")
+
+async def process_resource(i, resource, package_path, total, subject, temp_subject_dir, browser, semaphore):
+    """
+    Renders one resource to a PDF page in its own browser context and extracts its EPUB chapter.
+    Zip entries are read lazily from the downloaded package as the browser requests them.
+    """
+    async with semaphore:
+        logger(f"\n--- Processing resource {i+1}/{total} for {subject} ---")
         logger(f"  URL: {resource['url']}")
 
         try:
-            response = requests.get(resource['url'], headers={'User-Agent': USER_AGENT}, timeout=180)
-            response.raise_for_status()
-            zip_buffer = io.BytesIO(response.content)
-            logger("  [+] Downloaded resource to memory.")
-
-            with zipfile.ZipFile(zip_buffer) as z:
+            with zipfile.ZipFile(package_path) as z:
                 html_files = [f for f in z.namelist() if f.endswith(('.html', '.htm'))]
                 if not html_files:
-                    logger("  [!] No HTML file found. Skipping.")
-                    continue
-
-                index_file = next((f for f in html_files if 'index' in f.lower()), html_files[0])
-
-                extract_path = os.path.join(temp_subject_dir, f"res_{i+1}")
-                z.extractall(extract_path)
+                    logger(f"  [!] No HTML file found in resource {i+1}. Skipping.")
+                    return None
 
-                html_path = os.path.join(extract_path, index_file)
-                logger(f"  [*] Extracted to temp path for rendering: {html_path}")
+                index_file = find_entry_point(z, html_files)
+                logger(f"  [*] Rendering {index_file} straight from the package.")
 
                 page_pdf_path = os.path.join(temp_subject_dir, f"page_{i+1}.pdf")
-                browser_page = browser.new_page()
-                browser_page.goto(f"file://{os.path.abspath(html_path)}", wait_until='networkidle', timeout=60000)
-                time.sleep(3)
-                browser_page.pdf(path=page_pdf_path, format='A4', print_background=True)
-                browser_page.close()
-                pdf_page_files.append(page_pdf_path)
+                context = await browser.new_context()
+                try:
+                    await context.route(f"{PACKAGE_ORIGIN}/**", lambda route: serve_from_zip(route, z))
+                    if resource.get('text_only'):
+                        # Registered last so it sees requests before the package route.
+                        await context.route("**/*", skip_media)
+                    browser_page = await context.new_page()
+                    await browser_page.goto(f"{PACKAGE_ORIGIN}/{quote(index_file)}", wait_until='load', timeout=60000)
+                    await wait_until_ready(browser_page)
+                    pdf_bytes = await browser_page.pdf(path=page_pdf_path, format='A4', print_background=True)
+                finally:
+                    await context.close()
+                # Count pages from the bytes Playwright hands back, so the final merge never reopens the file.
+                page_count = await asyncio.to_thread(fast_page_count, io.BytesIO(pdf_bytes))
                 logger(f"  [+] Rendered PDF page: {page_pdf_path}")
 
-                with open(html_path, 'r', encoding='utf-8') as f_in:
-                    soup = BeautifulSoup(f_in.read(), 'html.parser')
-                    title = soup.title.string if soup.title else f"Chapter {i+1}"
-                    chapter_content = f"<h1>{title}</h1>\n{soup.body}"
-                    epub_chapters_content.append(chapter_content)
-                logger("  [+] Extracted EPUB content.")
-
-                shutil.rmtree(extract_path)
+                # The PDF page is already rendered; a bad chapter only drops this resource from the EPUB.
+                title, chapter_path = f"Chapter {i+1}", None
+                try:
+                    extracted_title, body = extract_title_and_body(z.read(index_file))
+                    title = extracted_title or title
+                    chapter_path = os.path.join(temp_subject_dir, f"chapter_{i+1:03d}.html")
+                    with open(chapter_path, 'w', encoding='utf-8') as f_out:
+                        f_out.write(f"<h1>{html.escape(title)}</h1>\n{body}")
+                    logger(f"  [+] Extracted EPUB content for resource {i+1}.")
+                except Exception as e:
+                    chapter_path = None
+                    logger(f"  [!] FAILED to extract EPUB content for resource {i+1}; keeping its PDF page. Error: {e}")
+
+            return {
+                'pdf_path': page_pdf_path,
+                'page_count': page_count,
+                'title': title,
+                'chapter_path': chapter_path
+            }
 
         except Exception as e:
             logger(f"[!!!] FAILED to process resource {resource['url']}. Error: {e}")
+            return None
+
+def fast_page_count(source):
+    """Reads the page count from the root of the page tree without walking its children."""
+    with pikepdf.Pdf.open(source) as pdf:
+        return int(pdf.Root.Pages.Count)
+
+def assemble_final_pdf(rendered, temp_subject_dir, final_pdf_path):
+    """
+    Merges the rendered pages with qpdf, then adds one bookmark per chapter with pikepdf.
+    When the qpdf executable is not installed, the pages are merged with pikepdf instead.
+    """
+    pdf_page_files = [r['pdf_path'] for r in rendered]
+    page_offsets = []
+    page_offset = 0
+    for r in rendered:
+        page_offsets.append(page_offset)
+        page_offset += r['page_count']
+
+    merged_pdf_path = os.path.join(temp_subject_dir, "merged.pdf")
+    if shutil.which('qpdf'):
+        subprocess.run(
+            ['qpdf', '--warning-exit-0', '--empty', '--pages', *pdf_page_files, '--', merged_pdf_path],
+            check=True, capture_output=True
+        )
+    else:
+        with pikepdf.Pdf.new() as merged:
+            for page_file in pdf_page_files:
+                with pikepdf.Pdf.open(page_file) as src:
+                    merged.pages.extend(src.pages)
+            merged.save(merged_pdf_path)
+
+    # The merged file is only read while stamping bookmarks, so map it instead of reading it into memory.
+    with pikepdf.Pdf.open(merged_pdf_path, access_mode=pikepdf.AccessMode.mmap) as pdf:
+        with pdf.open_outline() as outline:
+            outline.root.extend(
+                pikepdf.OutlineItem(r['title'], offset) for r, offset in zip(rendered, page_offsets)
+            )
+        pdf.save(final_pdf_path, linearize=False, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+
+def remove_dirs(paths):
+    """Deletes each directory tree, ignoring errors."""
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+async def process_subject(subject, resources, browser, workers):
+    """Processes all resources for a single subject, rendering up to `workers` of them at once."""
+    logger(f"\n{'='*40}")
+    logger(f"[*] Starting processing for subject: {subject}")
+    logger(f"{'='*40}")
+
+    temp_subject_dir = os.path.join(TEMP_DIR, subject)
+    if os.path.exists(temp_subject_dir):
+        # Leftovers from an interrupted run: move them aside under a unique name so a
+        # trash dir left by a run killed mid-delete can never be in the way.
+        os.rename(temp_subject_dir, tempfile.mkdtemp(prefix=f"{subject}.trash-", dir=TEMP_DIR))
+    trash_dirs = glob.glob(f"{glob.escape(temp_subject_dir)}.trash-*")
+    if trash_dirs:
+        # Delete them, and any older ones, while this run works.
+        # The thread is not a daemon, so the interpreter waits for it before exiting.
+        threading.Thread(target=remove_dirs, args=(trash_dirs,)).start()
+    os.makedirs(temp_subject_dir)
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(workers)
+    # Downloads run ahead of rendering on their own pool, but at most `workers * 2`
+    # resources are downloaded or downloading and not yet rendered, so the subject
+    # is never fetched all at once.
+    lookahead = asyncio.Semaphore(workers * 2)
+
+    async def fetch_and_render(i, resource):
+        # The render slot is only taken once the package is local, so a pending
+        # download never keeps the browser idle.
+        async with lookahead:
+            try:
+                package_path = await loop.run_in_executor(executor, download_package, i, resource)
+            except Exception as e:
+                logger(f"[!!!] FAILED to download resource {resource['url']}. Error: {e}")
+                return None
+            result = await process_resource(i, resource, package_path, len(resources), subject, temp_subject_dir, browser, semaphore)
+            if result is not None:
+                evict_cached_package(resource)
+            return result
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        results = await asyncio.gather(*(
+            fetch_and_render(i, resource) for i, resource in enumerate(resources)
+        ))
+
+    # gather() returns results in manifest order, whatever order the renders finished in.
+    rendered = [r for r in results if r is not None]
 
     logger(f"\n[*] Finalizing files for subject: {subject}")
 
-    if pdf_page_files:
+    if rendered:
         final_pdf_path = os.path.join(OUTPUT_DIR, f"PAU_{subject}_CREA.pdf")
         try:
-            with pikepdf.Pdf.new() as pdf:
-                for page_file in pdf_page_files:
-                    with pikepdf.Pdf.open(page_file) as src:
-                        pdf.pages.extend(src.pages)
-                pdf.save(final_pdf_path)
+            assemble_final_pdf(rendered, temp_subject_dir, final_pdf_path)
             logger(f"  [SUCCESS] Saved final PDF: {final_pdf_path}")
         except Exception as e:
             logger(f"[!!!] FAILED to save final PDF for {subject}. Error: {e}")
 
-    if epub_chapters_content:
+    if any(r['chapter_path'] for r in rendered):
         final_epub_path = os.path.join(OUTPUT_DIR, f"PAU_{subject}_CREA.epub")
-        full_html_content = "\n".join(epub_chapters_content)
+        chapter_files = [r['chapter_path'] for r in rendered if r['chapter_path']]
         try:
             process = subprocess.run(
-                ['pandoc', '-f', 'html', '-t', 'epub', '--toc', f'--metadata=title:{subject}', '-o', final_epub_path],
-                input=full_html_content, text=True, check=True, capture_output=True
+                ['pandoc', '-f', 'html', '-t', 'epub', '--toc', f'--metadata=title:{subject}', '-o', final_epub_path, *chapter_files],
+                text=True, check=True, capture_output=True
             )
             logger(f"  [SUCCESS] Saved final EPUB: {final_epub_path}")
         except subprocess.CalledProcessError as e:
@@ -129,30 +390,40 @@ def process_subject(subject, resources, browser):
     shutil.rmtree(temp_subject_dir)
     logger(f"  [+] Cleaned up temporary files for {subject}.")
 
+async def run(subject, resources, workers):
+    """Launches a single browser and processes the subject with it."""
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(args=BROWSER_ARGS)
+        await process_subject(subject, resources, browser, workers)
+        await browser.close()
+
 def main():
     """Main function to orchestrate the processing of a single subject."""
-    if len(sys.argv) != 2:
-        print("Usage: python process_crea.py <SubjectName>")
-        print("Example: python process_crea.py Matematicas")
-        sys.exit(1)
-
-    target_subject = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        description="Process the CREA materials of a single subject.",
+        epilog="Example: python process_crea.py Matematicas --workers 6"
+    )
+    parser.add_argument("subject", help="Subject name as it appears in the manifest")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"Resources rendered at once (default: min({RENDER_CONCURRENCY}, resource count))")
+    args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    target_subject = args.subject
 
     if not os.path.exists(LOG_FILE):
         open(LOG_FILE, 'w').close() # Create log file if it doesn't exist
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    if not os.path.exists(TEMP_DIR):
-        os.makedirs(TEMP_DIR)
+    os.makedirs(DOWNLOAD_CACHE, exist_ok=True)
 
     resources = get_resources_for_subject(target_subject)
     if not resources:
         return
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch()
-        process_subject(target_subject, resources, browser)
-        browser.close()
+    workers = args.workers or min(RENDER_CONCURRENCY, len(resources))
+    asyncio.run(run(target_subject, resources, workers))
 
     logger(f"\n[SUCCESS] Processing for subject {target_subject} is complete.")
 